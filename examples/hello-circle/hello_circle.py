@@ -25,7 +25,7 @@ if __name__ == '__main__':
         ),
         region=((-2, -2), (2, 2)),
         film_size=(512, 512),
-        n_tiles=6,
+        tile_size=32,
     )
 
     light2d.save(film, os.path.join(file_dir, 'hello_circle.png'))
@@ -19,6 +19,15 @@ direction of the surface (or its opposite, depending on the direction of the sca
 distance of `EPSILON`.
 """
 
+FASTMATH = {'nsz', 'arcp', 'contract', 'afn', 'reassoc'}
+"""
+Fast-math flags for JIT-ed functions.
+
+They allow the JIT compiler to reassociate and contract floating-point operations. The `nnan` and
+`ninf` flags are excluded, because infinities have special meanings in the ray tracer (e.g., the
+initial `t_max` of a ray is infinity) and must be handled correctly.
+"""
+
 F32Array = npt.NDArray[np.float32]
 
 Spectrum = NewType('Spectrum', F32Array)
@@ -40,14 +49,33 @@ An axis-aligned box is represented by a 2x2 float32 array.
 
 Ray = NewType('Ray', F32Array)
 """
-A ray is represented by a 1-D float32 array of length 5.
+A ray is represented by a 1-D float32 array of length 9.
 
 * `o`: Origin of the ray. It takes elements [0, 2) of this array.
-* `d`: Direction of the ray which may not necessarily be normalized. It takes elements [2, 4) of
-  this array.
-* `t_max`: Maximum distance from the origin where an intersection may occur. It takes element 5 of
-  this array. Note that distances in a ray is measured with respect to the direction vector's
-  length. This means that the farthest point where an intersection may occur is `o + d * t_max`.
+* `d`: Direction of the ray which must be normalized. It takes elements [2, 4) of this array.
+  Shapes rely on this to skip normalizing the direction in every intersection test, so anything
+  that creates a ray or changes its direction must keep it at unit length.
+* `t_max`: Maximum distance from the origin where an intersection may occur. It takes element 4 of
+  this array. Since `d` is normalized, the farthest point where an intersection may occur is
+  `o + d * t_max`, which is exactly `t_max` away from the origin.
+* `inv_d`: Component-wise reciprocal of `d`, whose components are infinite where those of `d` are
+  zero. It takes elements [5, 7) of this array.
+* `sign`: Signs of the components of `inv_d`, where 1 means negative and 0 means non-negative. It
+  takes elements [7, 9) of this array.
+
+`inv_d` and `sign` only depend on `d`. They are computed once whenever a ray is created or its
+direction is changed, so that they can be reused by all ray-box intersection tests of the ray.
+"""
+
+RayPacket = NewType('RayPacket', F32Array)
+"""
+A ray packet is a structure-of-arrays collection of rays, represented by a 2-D float32 array of
+shape `(9, n)`.
+
+Row `i` of this array holds element `i` (as defined by `Ray`) of all the `n` rays in the packet, so
+that the same field of different rays is contiguous in memory. For example, `packet[0]` is the x
+coordinates of the origins of all rays, and `packet[4]` is the `t_max` fields of all rays. Column
+`j` of this array is ray `j` of the packet.
 """
 
 SurfaceInteraction = NewType('SurfaceInteraction', F32Array)
@@ -62,8 +90,17 @@ A surface interaction is represented by a 1-D float32 array of length 12.
 * `attenuation`: Attenuation applied to the traced light intensity of the scattered ray. It takes
   elements [7, 10) of this array. If none of its components is positive, the ray will not be
   scattered and the `d_out` field is undefined.
-* `d_out`: If the ray will be scattered, this fields represents the direction of the scattered ray.
-  It takes elements [10, 12) of this array.
+* `d_out`: If the ray will be scattered, this fields represents the direction of the scattered ray,
+  which must be normalized as required by `Ray`. It takes elements [10, 12) of this array.
+"""
+
+RandomState = NewType('RandomState', npt.NDArray[np.uint64])
+"""
+A random state is the state of a PCG32 random number generator, represented by a 1-D uint64 array
+of length 1.
+
+The state is passed by reference to every JIT-ed function that draws random numbers, which advance
+it in place. Each rendering thread owns its own random state, so no synchronization is needed.
 """
 
 
@@ -88,11 +125,12 @@ class Shape(ABC):
     @property
     def bounds(self) -> AlignedBox:
         """
-        Returns the axis-aligned bounding box of this shape.
+        Returns the axis-aligned bounding box of this shape. The returned array is read-only.
         """
         if self._bounds is None:
             self._bounds = self._get_bounds()
-        return self._bounds.copy()
+            self._bounds.flags.writeable = False
+        return self._bounds
 
     @abstractmethod
     def _make_intersect_function(self) -> Callable[[Ray, SurfaceInteraction], bool]:
@@ -175,11 +213,12 @@ class Entity(ABC):
     @property
     def bounds(self) -> AlignedBox:
         """
-        Returns the axis-aligned bounding box of this entity.
+        Returns the axis-aligned bounding box of this entity. The returned array is read-only.
         """
         if self._bounds is None:
             self._bounds = self._get_bounds()
-        return self._bounds.copy()
+            self._bounds.flags.writeable = False
+        return self._bounds
 
     @abstractmethod
     def _make_intersect_function(self) -> Callable[[Ray, SurfaceInteraction], bool]:
@@ -218,22 +257,28 @@ class Integrator(ABC):
         self._integrate_function = None
 
     @abstractmethod
-    def _make_integrate_function(self) -> Callable[[AlignedBox], Spectrum]:
+    def _make_integrate_function(
+            self) -> Callable[[float, float, float, float, F32Array, RandomState], None]:
         """
-        Creates a JIT-ed function for calculating the light intensity of a given pixel.
+        Creates a JIT-ed function for calculating the light intensities of a grid of pixels.
 
         Users should not call this method directly. Use the `integrate_function` property instead.
         """
         ...
 
     @property
-    def integrate_function(self) -> Callable[[AlignedBox], Spectrum]:
+    def integrate_function(
+            self) -> Callable[[float, float, float, float, F32Array, RandomState], None]:
         """
-        Returns a JIT-ed function for calculating the light intensity of a given pixel.
-
-        * The first (and only) argument of the returned function is an axis-aligned box representing
-          the region occupied by this pixel.
-        * The return value of the returned function is the light intensity of this pixel.
+        Returns a JIT-ed function for calculating the light intensities of a grid of pixels.
+
+        * The first four arguments of the returned function are the minimum x, minimum y, maximum x,
+          and maximum y coordinates of the region occupied by the pixels.
+        * The fifth argument of the returned function is a float32 array of shape `(h, w, 3)`, which
+          may be a view into a larger image. The region is uniformly split into a `w`-by-`h` grid of
+          pixels, where rows go along the y axis and columns go along the x axis. The light
+          intensities of the pixels are written into this array.
+        * The sixth argument of the returned function is the random state used for sampling.
         """
         if self._integrate_function is None:
             self._integrate_function = self._make_integrate_function()
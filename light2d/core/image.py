@@ -2,17 +2,31 @@
 Functions for generating and saving images.
 """
 
-from multiprocessing import Pool
+from contextlib import contextmanager
+from typing import Callable, Iterator, Optional
 
+import numba
 import numpy as np
-from numba import njit
+import numpy.typing as npt
+from numba import njit, prange, types
 from PIL import Image
 
-from .base import AlignedBox, F32Array, Integrator
+from .base import FASTMATH, F32Array, Integrator, RandomState
+from .utils import seed_random_state
+
+_integrate_function_type = types.FunctionType(types.void(
+    types.float32, types.float32, types.float32, types.float32, types.float32[:, :, :],
+    types.uint64[::1]))
+"""
+Type of integrate functions when they are passed to the JIT-ed rendering functions. Integrate
+functions are passed as first-class functions, so that the rendering functions are compiled only
+once for all integrators and can be cached on disk.
+"""
 
 
 def render(integrator: Integrator, region: tuple[tuple[float, float], tuple[float, float]],
-           film_size: tuple[int, int], n_tiles: int = 1) -> F32Array:
+           film_size: tuple[int, int], tile_size: int = 32, n_threads: Optional[int] = None,
+           random_seed: Optional[int] = None) -> F32Array:
     """
     Renders an image of the given entity with the specified parameters.
 
@@ -22,94 +36,176 @@ def render(integrator: Integrator, region: tuple[tuple[float, float], tuple[floa
       x and y coordinates.
     * `film_size` is the width and height of the film. It should have the same aspect ratio as the
       specified region.
-    * `n_tiles` controls the multiprocessing setting. If this value is not greater than 1, rendering
-      is performed on a single process. Otherwise, if this value is greater than 1, the image is
-      uniformly split into a `n_tiles`-by-`n_tiles` grid of tiles, where each tile is rendered on a
-      separate process. Therefore, there are `n_tiles ^ 2` rendering processes in total.
+    * `tile_size` is the width and height of tiles in pixels. The image is split into a grid of
+      tiles of this size (tiles in the last row and column may be smaller), which are the units of
+      work handed out to the rendering threads one at a time. Small tiles balance the work among
+      threads better, while large tiles have better cache locality.
+    * `n_threads` is the number of threads used for rendering. If this value is `None`, all
+      threads available to Numba (by default, one per CPU core) are used. The number of threads
+      never exceeds the number of tiles or the number of threads available to Numba.
+    * `random_seed` seeds the random numbers used for sampling. Every tile has its own random state
+      derived from this seed, so the rendered image only depends on the seed and the tile size,
+      but not on the number of threads or the order in which tiles are rendered. If this value is
+      `None`, a different seed is used for every call.
     * The return value is the rendered image represented by a float32 array of shape
       `(film_size[1], film_size[0], 3)`.
     """
     integrate = integrator.integrate_function
     region = np.array(region, np.float32)
+    tile_size = max(tile_size, 1)
 
-    @njit
-    def render_tile(params: tuple[AlignedBox, tuple[int, int], int]) -> F32Array:
-        tile_region = params[0]
-        tile_size = params[1]
-        random_seed = params[2]
-        np.random.seed(random_seed)
-
-        x_range = np.linspace(tile_region[0, 0], tile_region[1, 0], tile_size[0] + 1)
-        y_range = np.linspace(tile_region[0, 1], tile_region[1, 1], tile_size[1] + 1)
-        tile = np.empty((tile_size[1], tile_size[0], 3), np.float32)
-
-        pixel_region = np.empty((2, 2), np.float32)
-        for row in range(tile_size[1]):
-            pixel_region[0, 1] = y_range[row]
-            pixel_region[1, 1] = y_range[row + 1]
-            for col in range(tile_size[0]):
-                pixel_region[0, 0] = x_range[col]
-                pixel_region[1, 0] = x_range[col + 1]
-                tile[row, col] = integrate(pixel_region)
-
-        return tile
-
-    if not n_tiles > 1:
-        return render_tile((region, film_size,
-                            np.random.randint(np.uint32(0), np.uint32(0xFFFFFFFF))))
-
-    tile_width = -(-film_size[0] // n_tiles)
-    tile_col_range = np.arange(n_tiles + 1) * tile_width
+    n_cols = -(-film_size[0] // tile_size)
+    tile_col_range = np.arange(n_cols + 1, dtype=np.int64) * tile_size
     tile_col_range[-1] = film_size[0]
     tile_x_range = (film_size[0] - tile_col_range).astype(np.float32) / np.float32(film_size[0]) * \
         region[0, 0] + tile_col_range.astype(np.float32) / np.float32(film_size[0]) * region[1, 0]
 
-    tile_height = -(-film_size[1] // n_tiles)
-    tile_row_range = np.arange(n_tiles + 1) * tile_height
+    n_rows = -(-film_size[1] // tile_size)
+    tile_row_range = np.arange(n_rows + 1, dtype=np.int64) * tile_size
     tile_row_range[-1] = film_size[1]
     tile_y_range = (film_size[1] - tile_row_range).astype(np.float32) / np.float32(film_size[1]) * \
         region[0, 1] + tile_row_range.astype(np.float32) / np.float32(film_size[1]) * region[1, 1]
 
-    process_args = []
-    tile_indices = []
-    for i in range(n_tiles):
-        y_min = tile_y_range[i]
-        y_max = tile_y_range[i + 1]
-        row_min = tile_row_range[i]
-        row_max = tile_row_range[i + 1]
-        for j in range(n_tiles):
-            x_min = tile_x_range[j]
-            x_max = tile_x_range[j + 1]
-            col_min = tile_col_range[j]
-            col_max = tile_col_range[j + 1]
-
-            process_args.append((
-                np.array(((x_min, y_min), (x_max, y_max))),
-                (col_max - col_min, row_max - row_min),
-                np.random.randint(np.uint32(0), np.uint32(0xFFFFFFFF)),
-            ))
-            tile_indices.append(((row_min, row_max), (col_min, col_max)))
-
-    with Pool(np.square(n_tiles)) as pool:
-        tiles = pool.map(render_tile, process_args)
+    x_min, y_min = np.meshgrid(tile_x_range[:-1], tile_y_range[:-1])
+    x_max, y_max = np.meshgrid(tile_x_range[1:], tile_y_range[1:])
+    tile_regions = np.stack((x_min, y_min, x_max, y_max), axis=-1).reshape(-1, 2, 2)
+
+    col_min, row_min = np.meshgrid(tile_col_range[:-1], tile_row_range[:-1])
+    col_max, row_max = np.meshgrid(tile_col_range[1:], tile_row_range[1:])
+    tile_indices = np.stack((row_min, row_max, col_min, col_max), axis=-1).reshape(-1, 2, 2)
+
+    random_seeds = np.random.default_rng(random_seed).integers(1 << 32, size=len(tile_regions),
+                                                               dtype=np.uint32)
+
     film = np.empty((film_size[1], film_size[0], 3), np.float32)
-    for tile, ((row_min, row_max), (col_min, col_max)) in zip(tiles, tile_indices):
-        film[row_min:row_max, col_min:col_max] = tile
+    with _use_threads(n_threads, len(tile_regions)):
+        _render_tiles(integrate, film, tile_regions, tile_indices, random_seeds)
     return film
 
 
+def render_pixels(integrator: Integrator, regions: F32Array, n_threads: Optional[int] = None,
+                  random_seed: Optional[int] = None) -> F32Array:
+    """
+    Calculates the light intensities of a batch of independent pixels in parallel.
+
+    * `integrator` is the integrator used to calculate light intensities of pixels.
+    * `regions` is an array of shape `(n, 2, 2)`, whose element `i` is the region occupied by pixel
+      `i` as an `AlignedBox`.
+    * `n_threads` is the number of threads used for the calculation, as in `render`.
+    * `random_seed` seeds the random numbers used for sampling. Every pixel has its own random
+      state derived from this seed and its index, so pixels never share a random sequence, even if
+      their regions are identical. If this value is `None`, a different seed is used for every
+      call.
+    * The return value is a float32 array of shape `(n, 3)`, whose row `i` is the light intensity
+      of pixel `i`.
+    """
+    integrate = integrator.integrate_function
+    regions = np.ascontiguousarray(regions, np.float32).reshape(-1, 2, 2)
+    batch_seed = np.random.default_rng(random_seed).integers(1 << 32, dtype=np.uint32)
+
+    pixels = np.empty((len(regions), 3), np.float32)
+    with _use_threads(n_threads, len(regions)):
+        _render_pixels(integrate, pixels, regions, batch_seed)
+    return pixels
+
+
 def save(film: F32Array, filename: str, gamma: float = 2.2) -> None:
     """
     Saves the rendered image into an image file.
 
-    * `film` is the rendered image.
+    * `film` is the rendered image. Films of other floating-point types (e.g., float16 films kept to
+      save memory) are converted to float32 before saving.
     * `filename` is the name of the image file.
     * `gamma` is used for gamma correction. The color space of the saved image is assumed to be
       sRGB, so the default gamma value is 2.2. Set this value to 1 if no gamma correction should be
       performed.
     """
-    film = np.power(film, np.float32(1 / gamma))
-    film *= 255
-    np.clip(film, 0, 255, out=film)
-    film = np.flipud(film.astype(np.uint8))
-    Image.fromarray(film, 'RGB').save(filename)
+    film = np.ascontiguousarray(film, np.float32)
+    image = np.empty(film.shape, np.uint8)
+    _pack_image(film, np.float32(1 / gamma), image)
+    Image.fromarray(image, 'RGB').save(filename)
+
+
+@contextmanager
+def _use_threads(n_threads: Optional[int], n_tasks: int) -> Iterator[None]:
+    """
+    Runs the enclosed parallel rendering function with the given number of threads (or all threads
+    available to Numba if it is `None`), but never more threads than tasks. Tasks are handed out to
+    the threads one at a time.
+    """
+    if n_threads is None:
+        n_threads = numba.config.NUMBA_NUM_THREADS
+    n_threads = max(min(n_threads, numba.config.NUMBA_NUM_THREADS, n_tasks), 1)
+
+    previous_n_threads = numba.get_num_threads()
+    numba.set_num_threads(n_threads)
+    try:
+        with numba.parallel_chunksize(1):
+            yield
+    finally:
+        numba.set_num_threads(previous_n_threads)
+
+
+@njit(types.void(_integrate_function_type, types.float32[:, :, :], types.float32, types.float32,
+                 types.float32, types.float32, types.uint32), cache=True)
+def _render_tile(integrate: Callable[[float, float, float, float, F32Array, RandomState], None],
+                 tile: F32Array, x_min: float, y_min: float, x_max: float, y_max: float,
+                 random_seed: int) -> None:
+    """
+    Renders a tile of the film, which is a view into the film array. The random state of the tile is
+    seeded from `random_seed`, so that the tile is rendered identically by any thread.
+    """
+    random_state = np.empty(1, np.uint64)
+    seed_random_state(random_state, random_seed)
+    integrate(x_min, y_min, x_max, y_max, tile, random_state)
+
+
+@njit(types.void(_integrate_function_type, types.float32[:, :, ::1], types.float32[:, :, ::1],
+                 types.int64[:, :, ::1], types.uint32[::1]), parallel=True, cache=True)
+def _render_tiles(integrate: Callable[[float, float, float, float, F32Array, RandomState], None],
+                  film: F32Array, tile_regions: F32Array, tile_indices: npt.NDArray[np.int64],
+                  random_seeds: npt.NDArray[np.uint32]) -> None:
+    """
+    Renders all tiles of the film in parallel. Every thread writes its tiles directly into views of
+    the film, so no per-tile buffers are allocated or copied back.
+    """
+    for i in prange(len(tile_regions)):
+        row_min, row_max = tile_indices[i, 0]
+        col_min, col_max = tile_indices[i, 1]
+        x_min, y_min = tile_regions[i, 0]
+        x_max, y_max = tile_regions[i, 1]
+        _render_tile(integrate, film[row_min:row_max, col_min:col_max], x_min, y_min, x_max, y_max,
+                     random_seeds[i])
+
+
+@njit(types.void(_integrate_function_type, types.float32[:, ::1], types.float32[:, :, ::1],
+                 types.uint32), parallel=True, cache=True)
+def _render_pixels(integrate: Callable[[float, float, float, float, F32Array, RandomState], None],
+                   pixels: F32Array, regions: F32Array, batch_seed: int) -> None:
+    """
+    Renders a batch of independent pixels in parallel. The random state of pixel `i` is seeded from
+    `batch_seed` in the upper 32 bits and `i` in the lower 32 bits.
+    """
+    for i in prange(len(regions)):
+        random_state = np.empty(1, np.uint64)
+        seed_random_state(random_state, np.uint64(batch_seed) << np.uint64(32) | np.uint64(i))
+        integrate(regions[i, 0, 0], regions[i, 0, 1], regions[i, 1, 0], regions[i, 1, 1],
+                  pixels[i:i + 1, np.newaxis], random_state)
+
+
+@njit(types.void(types.float32[:, :, ::1], types.float32, types.uint8[:, :, ::1]), parallel=True,
+      cache=True, fastmath=FASTMATH)
+def _pack_image(film: F32Array, inv_gamma: float, image: npt.NDArray[np.uint8]) -> None:
+    """
+    Applies gamma correction to the film, converts it to 8-bit colors, and flips it vertically, all
+    in a single pass over the film.
+    """
+    height, width, _ = film.shape
+    for row in prange(height):
+        for col in range(width):
+            for channel in range(3):
+                value = film[height - 1 - row, col, channel] ** inv_gamma * np.float32(255)
+                # The clamping bounds are the first operands of `max` and `min`, which keep their
+                # first operand when compared with NaN, so that NaN pixels become 0.
+                image[row, col, channel] = np.uint8(min(np.float32(255),
+                                                        max(np.float32(0), value)))
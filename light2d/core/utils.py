@@ -5,15 +5,88 @@ Utility functions for the core and other sub-packages.
 from typing import Iterable
 
 import numpy as np
+from numba import njit
 
-from .base import AlignedBox
+from .base import FASTMATH, AlignedBox, RandomState
 
 
 def aligned_box_union(boxes: Iterable[AlignedBox]) -> AlignedBox:
-    union_box = np.empty((2, 2), np.float32)
-    union_box[0] = np.inf
-    union_box[1] = -np.inf
-    for box in boxes:
-        union_box[0] = np.min(union_box[0], box[0])
-        union_box[1] = np.max(union_box[1], box[1])
-    return union_box
+    """
+    Calculates the smallest axis-aligned box containing all the given boxes. If no box is given, the
+    minimum and maximum coordinates of the returned box are positive and negative infinities.
+    """
+    boxes = np.array(tuple(boxes), np.float32).reshape(-1, 2, 2)
+    return np.stack((boxes[:, 0].min(axis=0, initial=np.inf),
+                     boxes[:, 1].max(axis=0, initial=-np.inf)))
+
+
+@njit(inline='always', fastmath=FASTMATH)
+def intersect_aligned_box(ox: float, oy: float, inv_dx: float, inv_dy: float, t_max: float,
+                          x_near: float, y_near: float, x_far: float, y_far: float) -> float:
+    """
+    Tests whether a ray intersects an axis-aligned box, using the branchless slab test by Williams
+    et al.
+
+    * `ox` and `oy` are the origin of the ray.
+    * `inv_dx` and `inv_dy` are the reciprocals of the direction of the ray. They are infinite if
+      the corresponding direction component is zero.
+    * `t_max` is the maximum distance of the ray.
+    * `x_near` and `x_far` are the x coordinates of the slabs where the ray enters and exits the
+      box. If the `sign` of the ray's x direction is 0, they are the minimum and maximum x
+      coordinates of the box, respectively. Otherwise, they are the maximum and minimum x
+      coordinates. This also applies to `y_near` and `y_far`. Selecting the slabs by the signs of
+      the ray saves the comparisons between the distances to the minimum and maximum slabs.
+    * The return value is the distance where the ray enters the box (or 0 if the origin is inside
+      the box), if the ray intersects the box before `t_max`. Otherwise, the return value is
+      infinity.
+
+    If the ray is parallel to an axis and its origin lies exactly on a slab of that axis, the
+    distance to the slab is `0 * inf`, which is NaN. The running distances are always the first
+    operands of `max` and `min`, which keep their first operand when compared with NaN, so such a
+    slab is ignored instead of deciding the result.
+    """
+    t_near = max(max(np.float32(0), (x_near - ox) * inv_dx), (y_near - oy) * inv_dy)
+    t_far = min(min(t_max, (x_far - ox) * inv_dx), (y_far - oy) * inv_dy)
+    return t_near if t_near <= t_far and t_near < t_max else np.float32(np.inf)
+
+
+@njit(inline='always')
+def random_uint32(state: RandomState) -> int:
+    """
+    Advances the random state and returns a uniformly distributed 32-bit unsigned integer, using the
+    PCG32 (XSH-RR) generator by O'Neill.
+    """
+    old_state = state[0]
+    state[0] = old_state * np.uint64(6364136223846793005) + np.uint64(1442695040888963407)
+    x = ((old_state >> np.uint64(18)) ^ old_state) >> np.uint64(27) & np.uint64(0xFFFFFFFF)
+    r = old_state >> np.uint64(59)
+    x = (x >> r | x << (np.uint64(32) - r & np.uint64(31))) & np.uint64(0xFFFFFFFF)
+    return np.uint32(x)
+
+
+@njit(inline='always')
+def seed_random_state(state: RandomState, seed: int) -> None:
+    """
+    Initializes the random state from the given seed.
+    """
+    state[0] = np.uint64(0)
+    random_uint32(state)
+    state[0] += np.uint64(seed)
+    random_uint32(state)
+
+
+@njit(inline='always')
+def random_uniform(state: RandomState, low: float, high: float) -> float:
+    """
+    Returns a float32 number uniformly distributed in `[low, high)`.
+    """
+    u = np.float32(random_uint32(state) >> np.uint32(8)) * np.float32(1 / (1 << 24))
+    return low + (high - low) * u
+
+
+@njit(inline='always')
+def random_index(state: RandomState, n: int) -> int:
+    """
+    Returns an integer uniformly distributed in `[0, n)`, where `n` is less than `2 ^ 32`.
+    """
+    return np.int64(np.uint64(random_uint32(state)) * np.uint64(n) >> np.uint64(32))
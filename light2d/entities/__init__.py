@@ -2,5 +2,6 @@
 Child classes of the entity base class.
 """
 
+from .bvh_aggregate import BVHAggregate
 from .flat_aggregate import FlatAggregate
 from .simple_entity import SimpleEntity
@@ -0,0 +1,246 @@
+"""
+Definition of the BVH aggregate.
+"""
+
+from typing import Callable, Iterable
+
+import numpy as np
+from numba import literal_unroll, njit
+
+from ..core.base import FASTMATH, AlignedBox, Entity, F32Array, Ray, SurfaceInteraction
+from ..core.utils import aligned_box_union, intersect_aligned_box
+
+
+class BVHAggregate(Entity):
+    """
+    BVH aggregate is a collection of entities organized inside a bounding volume hierarchy (BVH).
+
+    The BVH is first built as a binary tree whose leaves are the consisting entities, by sorting the
+    entities along a Morton curve through the centroids of their bounding boxes and then splitting
+    the sorted entities recursively at the highest differing bit of their Morton codes. The binary
+    tree is then collapsed into a 4-wide tree, where every node stores the bounding boxes of its (up
+    to) 4 children. A ray is tested against all children of a node at once, and the intersected
+    children are visited from near to far. A ray only tests the entities whose ancestor nodes have
+    bounding boxes intersected by the ray, which takes `O(log n)` time for `n` uniformly
+    distributed entities.
+    """
+
+    def __init__(self, entities: Iterable[Entity]):
+        """
+        Creates a BVH aggregate from the given iterable of consisting entities.
+        """
+        super().__init__()
+        self._entities = list(entities)
+        self._build_nodes()
+
+    def _build_nodes(self) -> None:
+        """
+        Builds the nodes of the BVH, which are stored in the following arrays:
+
+        * `_node_bounds`: A float32 array of shape `(n_nodes, 4, 4)`. Rows 0 to 3 of each node are
+          the minimum x, minimum y, maximum x, and maximum y coordinates of the bounding boxes of
+          its 4 children, so that a node fills exactly 64 bytes.
+        * `_node_children`: An int32 array of shape `(n_nodes, 4)`. A positive value is the index of
+          a child node, a negative value `-i - 1` is a leaf containing entity `i`, and 0 is an
+          empty slot.
+
+        The root node is node 0, and the nodes are stored in depth-first order: every node is
+        immediately followed by the subtree of its first child node, and then the subtrees of its
+        other child nodes. A ray going down the tree therefore mostly reads nodes that are close in
+        memory. The number of levels of the tree is stored in `_n_levels`.
+        """
+        entity_bounds = np.array([e.bounds for e in self._entities], np.float32).reshape(-1, 2, 2)
+        codes = _morton_codes(entity_bounds.mean(axis=1))
+        order = np.argsort(codes, kind='stable')
+        codes = codes[order]
+        entity_bounds = entity_bounds[order]
+
+        binary_bounds = []
+        binary_children = []
+        binary_entities = []
+
+        def build(begin: int, end: int) -> int:
+            node = len(binary_bounds)
+            binary_bounds.append(aligned_box_union(entity_bounds[begin:end]))
+            binary_children.append([-1, -1])
+            binary_entities.append(-1)
+            if end - begin == 1:
+                binary_entities[node] = order[begin]
+                return node
+            split = _find_split(codes, begin, end)
+            binary_children[node][0] = build(begin, split)
+            binary_children[node][1] = build(split, end)
+            return node
+
+        def collapse(node: int) -> list[int]:
+            # Repeatedly replaces the internal node with the largest bounding box by its two
+            # children, until there are 4 nodes or all nodes are leaves.
+            if binary_entities[node] >= 0:
+                return [node]
+            nodes = list(binary_children[node])
+            while len(nodes) < 4:
+                internal = [n for n in nodes if binary_entities[n] < 0]
+                if not internal:
+                    break
+                largest = max(internal, key=lambda n: np.sum(np.diff(binary_bounds[n], axis=0)))
+                i = nodes.index(largest)
+                nodes[i:i + 1] = binary_children[largest]
+            return nodes
+
+        node_bounds = []
+        node_children = []
+        self._n_levels = 0
+
+        def build_wide(binary_node: int, level: int) -> int:
+            node = len(node_bounds)
+            bounds = np.empty((4, 4), np.float32)
+            bounds[:2] = np.inf
+            bounds[2:] = -np.inf
+            children = np.zeros(4, np.int32)
+            node_bounds.append(bounds)
+            node_children.append(children)
+            self._n_levels = max(self._n_levels, level)
+            for lane, child in enumerate(collapse(binary_node)):
+                bounds[:, lane] = binary_bounds[child].flatten()
+                if binary_entities[child] >= 0:
+                    children[lane] = -binary_entities[child] - 1
+                else:
+                    children[lane] = build_wide(child, level + 1)
+            return node
+
+        if self._entities:
+            build_wide(build(0, len(self._entities)), 1)
+        self._node_bounds = np.array(node_bounds, np.float32).reshape(-1, 4, 4)
+        self._node_children = np.array(node_children, np.int32).reshape(-1, 4)
+
+    def _get_bounds(self) -> AlignedBox:
+        return aligned_box_union(e.bounds for e in self._entities)
+
+    def _make_intersect_function(self) -> Callable[[Ray, SurfaceInteraction], bool]:
+        entities_intersect = tuple(e.intersect_function for e in self._entities)
+        node_bounds = self._node_bounds
+        node_children = self._node_children
+        n_nodes = len(node_children)
+        # Every level of the tree leaves at most 3 siblings on the stack, except that the deepest
+        # level may leave 4.
+        stack_capacity = 4 * self._n_levels
+
+        @njit
+        def intersect_entity(i_entity: int, ray: Ray, interaction: SurfaceInteraction) -> bool:
+            k = 0
+            is_intersected = False
+            for entity_intersect in literal_unroll(entities_intersect):
+                if k == i_entity:
+                    is_intersected = entity_intersect(ray, interaction)
+                k += 1
+            return is_intersected
+
+        @njit(fastmath=FASTMATH)
+        def intersect(ray: Ray, interaction: SurfaceInteraction) -> bool:
+            if n_nodes == 0:
+                return False
+            ox = ray[0]
+            oy = ray[1]
+            inv_dx = ray[5]
+            inv_dy = ray[6]
+            # Rows of the near and far slabs in the node bounds, selected by the signs of the ray.
+            x_near = 2 * np.int32(ray[7])
+            y_near = 1 + 2 * np.int32(ray[8])
+            x_far = 2 - x_near
+            y_far = 4 - y_near
+
+            # Each stack entry is a child (as encoded in `node_children`) and the distance where
+            # the ray enters its bounding box. The root node is pushed as child 0.
+            is_intersected = np.uint8(0)
+            stack_children = np.empty(stack_capacity, np.int32)
+            stack_t = np.empty(stack_capacity, np.float32)
+            stack_children[0] = 0
+            stack_t[0] = 0
+            stack_size = 1
+            while stack_size > 0:
+                stack_size -= 1
+                if not stack_t[stack_size] < ray[4]:
+                    continue
+                child = stack_children[stack_size]
+                if child < 0:
+                    is_intersected |= np.uint8(intersect_entity(-child - 1, ray, interaction))
+                    continue
+
+                bounds = node_bounds[child]
+                t_max = ray[4]
+                t0 = intersect_aligned_box(ox, oy, inv_dx, inv_dy, t_max,
+                                           bounds[x_near, 0], bounds[y_near, 0],
+                                           bounds[x_far, 0], bounds[y_far, 0])
+                t1 = intersect_aligned_box(ox, oy, inv_dx, inv_dy, t_max,
+                                           bounds[x_near, 1], bounds[y_near, 1],
+                                           bounds[x_far, 1], bounds[y_far, 1])
+                t2 = intersect_aligned_box(ox, oy, inv_dx, inv_dy, t_max,
+                                           bounds[x_near, 2], bounds[y_near, 2],
+                                           bounds[x_far, 2], bounds[y_far, 2])
+                t3 = intersect_aligned_box(ox, oy, inv_dx, inv_dy, t_max,
+                                           bounds[x_near, 3], bounds[y_near, 3],
+                                           bounds[x_far, 3], bounds[y_far, 3])
+                c0, c1, c2, c3 = node_children[child]
+
+                # Sorts the children by their distances with a 5-comparator sorting network, and
+                # then pushes them from far to near, so that nearer children are visited first.
+                t0, c0, t1, c1 = _sort_pair(t0, c0, t1, c1)
+                t2, c2, t3, c3 = _sort_pair(t2, c2, t3, c3)
+                t0, c0, t2, c2 = _sort_pair(t0, c0, t2, c2)
+                t1, c1, t3, c3 = _sort_pair(t1, c1, t3, c3)
+                t1, c1, t2, c2 = _sort_pair(t1, c1, t2, c2)
+                for t, c in ((t3, c3), (t2, c2), (t1, c1), (t0, c0)):
+                    if c != 0 and t < np.inf:
+                        stack_children[stack_size] = c
+                        stack_t[stack_size] = t
+                        stack_size += 1
+            return bool(is_intersected)
+
+        return intersect
+
+
+@njit(inline='always')
+def _sort_pair(t_a: float, c_a: int, t_b: float, c_b: int) -> tuple[float, int, float, int]:
+    """
+    Compare-and-swap step of a sorting network, which orders two children by their distances.
+    """
+    if t_b < t_a:
+        return t_b, c_b, t_a, c_a
+    return t_a, c_a, t_b, c_b
+
+
+def _morton_codes(points: F32Array) -> np.ndarray:
+    """
+    Calculates the 32-bit Morton codes of 2-D points, which are quantized to 16 bits per axis within
+    their bounding box.
+    """
+    lower = points.min(axis=0, initial=np.inf)
+    upper = points.max(axis=0, initial=-np.inf)
+    extent = np.where(upper > lower, upper - lower, 1)
+    normalized = np.nan_to_num(np.clip((points - lower) / extent, 0, 1))
+    quantized = (normalized * 0xFFFF).astype(np.uint32)
+
+    codes = np.zeros(len(points), np.uint32)
+    for axis in range(2):
+        x = quantized[:, axis]
+        x = (x | (x << 8)) & 0x00FF00FF
+        x = (x | (x << 4)) & 0x0F0F0F0F
+        x = (x | (x << 2)) & 0x33333333
+        x = (x | (x << 1)) & 0x55555555
+        codes |= x << axis
+    return codes
+
+
+def _find_split(codes: np.ndarray, begin: int, end: int) -> int:
+    """
+    Finds where to split the sorted Morton codes in `[begin, end)`, which is the first code whose
+    highest differing bit (among the range) is set. If all codes are equal, the range is split in
+    the middle.
+    """
+    first = int(codes[begin])
+    last = int(codes[end - 1])
+    if first == last:
+        return (begin + end) // 2
+    bit = (first ^ last).bit_length() - 1
+    threshold = np.uint32(last >> bit << bit)
+    return begin + int(np.searchsorted(codes[begin:end], threshold))
@@ -4,6 +4,7 @@ Definition of the flat aggregate.
 
 from typing import Callable, Iterable
 
+import numpy as np
 from numba import literal_unroll, njit
 
 from ..core.base import AlignedBox, Entity, Ray, SurfaceInteraction
@@ -30,9 +31,11 @@ class FlatAggregate(Entity):
 
         @njit
         def intersect(ray: Ray, interaction: SurfaceInteraction) -> bool:
-            is_intersected = False
+            # Every entity is tested, and each test only accepts intersections closer than the
+            # current `t_max` of the ray. The flags are combined without branching.
+            is_intersected = np.uint8(0)
             for entity_intersect in literal_unroll(entities_intersect):
-                is_intersected = is_intersected or entity_intersect(ray, interaction)
-            return is_intersected
+                is_intersected |= np.uint8(entity_intersect(ray, interaction))
+            return bool(is_intersected)
 
         return intersect
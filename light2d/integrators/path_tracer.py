@@ -5,9 +5,12 @@ Definition of the path tracer integrator.
 from typing import Callable
 
 import numpy as np
+import numpy.typing as npt
 from numba import njit
 
-from ..core.base import EPSILON, AlignedBox, Entity, Integrator, Ray, Spectrum, SurfaceInteraction
+from ..core.base import (EPSILON, FASTMATH, Entity, F32Array, Integrator, RandomState, Ray,
+                         RayPacket, Spectrum, SurfaceInteraction)
+from ..core.utils import random_index, random_uniform
 
 
 class PathTracer(Integrator):
@@ -22,12 +25,21 @@ class PathTracer(Integrator):
 
     For an individual light path, the integrator guarantees to trace for the first `n_steps` (as
     long as the ray is scattered by the materials). After that, for every additional step the
-    integrator may stop tracing by a probability of `russian_roulette_q`. The integrator is then
-    able to calculate an unbiased estimate of the sum of light intensities along the light path.
+    integrator may stop tracing by a probability of `q = max(russian_roulette_q, 1 - a)`, where `a`
+    is the largest channel of the attenuation accumulated along the path so far, so that paths
+    carrying little light are stopped sooner. Every path that continues is reweighted by
+    `1 / (1 - q)` to compensate for the stopped ones.
+
+    To bound the tracing time, no path is traced for more than `max_russian_roulette_steps` steps
+    after the first `n_steps`. The light that would be gathered beyond this cap is dropped, so the
+    estimate of the sum of light intensities along the light path is slightly biased towards zero.
+    The cap trades this bias for a bounded tracing time, and the estimate is only unbiased in the
+    limit of an unbounded cap. For example, with the default cap of 32 and `q = 0.05`, about
+    `0.95 ^ 32 = 19%` of the paths that enter Russian roulette and keep scattering reach the cap.
     """
 
     def __init__(self, entity: Entity, n_samples: int, n_steps: int = 3,
-                 russian_roulette_q: float = 0.05):
+                 russian_roulette_q: float = 0.05, max_russian_roulette_steps: int = 32):
         """
         Creates a path tracer for the given entity with the specified parameters. See the class
         documentation for details about the parameters.
@@ -37,94 +49,151 @@ class PathTracer(Integrator):
         self._n_samples = np.uint32(n_samples)
         self._n_steps = np.uint32(n_steps)
         self._russian_roulette_q = np.float32(russian_roulette_q)
+        self._max_russian_roulette_steps = np.uint32(max_russian_roulette_steps)
+        self._angle_step = np.float32(np.pi * 2 / (n_samples * n_samples))
 
-    def _make_integrate_function(self) -> Callable[[AlignedBox], Spectrum]:
+    def _make_integrate_function(
+            self) -> Callable[[float, float, float, float, F32Array, RandomState], None]:
         n_samples = self._n_samples
         n_steps = self._n_steps
         russian_roulette_q = self._russian_roulette_q
+        max_russian_roulette_steps = self._max_russian_roulette_steps
+        angle_step = self._angle_step
         entity_intersect = self._entity.intersect_function
 
-        @njit
+        @njit(inline='always', fastmath=FASTMATH, error_model='numpy')
         def get_scattered_ray(ray: Ray, interaction: SurfaceInteraction) -> None:
-            p = interaction[0:2]
-            n = interaction[2:4]
-            d_out = interaction[10:12]
-            n_offset = n * (EPSILON / np.linalg.norm(n))
-            if np.dot(d_out, n) < 0:
-                o_out = p - n_offset
-            else:
-                o_out = p + n_offset
-            ray[0:2] = o_out
-            ray[2:4] = d_out
+            nx = interaction[2]
+            ny = interaction[3]
+            d_out_x = interaction[10]
+            d_out_y = interaction[11]
+            # The origin is offset to the side of the surface where the ray is scattered to.
+            offset = np.copysign(EPSILON / np.sqrt(nx * nx + ny * ny), d_out_x * nx + d_out_y * ny)
+            ray[0] = interaction[0] + nx * offset
+            ray[1] = interaction[1] + ny * offset
+            ray[2] = d_out_x
+            ray[3] = d_out_y
             ray[4] = np.inf
-
-        @njit
-        def trace(ray: Ray) -> Spectrum:
-            interaction = np.empty(12, np.float32)
-            li_sum = np.zeros(3, np.float32)
-            net_attenuation = np.ones(3, np.float32)
+            ray[5] = np.float32(1) / d_out_x
+            ray[6] = np.float32(1) / d_out_y
+            ray[7] = ray[5] < 0
+            ray[8] = ray[6] < 0
+
+        @njit(fastmath=FASTMATH, error_model='numpy')
+        def trace(ray: Ray, interaction: SurfaceInteraction, li_sum: Spectrum,
+                  net_attenuation: Spectrum, random_state: RandomState) -> None:
+            # The light intensity is summed into `li_sum`. `interaction` and `net_attenuation` are
+            # scratch arrays preallocated by the caller, so that no array is allocated per ray.
+            for c in range(3):
+                li_sum[c] = 0
+                net_attenuation[c] = 1
 
             for _ in range(n_steps):
                 if not entity_intersect(ray, interaction):
-                    return li_sum
-                li = interaction[4:7]
-                li_sum += li * net_attenuation
-                attenuation = interaction[7:10]
-                if not np.any(attenuation > 0):
-                    return li_sum
-                net_attenuation *= attenuation
+                    return
+                for c in range(3):
+                    li_sum[c] += interaction[4 + c] * net_attenuation[c]
+                if not (interaction[7] > 0 or interaction[8] > 0 or interaction[9] > 0):
+                    return
+                for c in range(3):
+                    net_attenuation[c] *= interaction[7 + c]
                 get_scattered_ray(ray, interaction)
 
-            while True:
-                if not np.float32(np.random.uniform(0, 1)) < russian_roulette_q or \
-                   not entity_intersect(ray, interaction):
-                    return li_sum
-                li = interaction[4:7]
-                net_attenuation /= 1 - russian_roulette_q
-                li_sum += li * net_attenuation
-                attenuation = interaction[7:10]
-                if not np.any(attenuation > 0):
-                    return li_sum
-                net_attenuation *= attenuation
+            for _ in range(max_russian_roulette_steps):
+                q = max(russian_roulette_q, np.float32(1) - max(
+                    net_attenuation[0], net_attenuation[1], net_attenuation[2]))
+                u = random_uniform(random_state, np.float32(0), np.float32(1))
+                if u < q or not entity_intersect(ray, interaction):
+                    return
+                inv_survival_probability = np.float32(1) / (np.float32(1) - q)
+                for c in range(3):
+                    net_attenuation[c] *= inv_survival_probability
+                    li_sum[c] += interaction[4 + c] * net_attenuation[c]
+                if not (interaction[7] > 0 or interaction[8] > 0 or interaction[9] > 0):
+                    return
+                for c in range(3):
+                    net_attenuation[c] *= interaction[7 + c]
                 get_scattered_ray(ray, interaction)
 
-        @njit
-        def integrate(region: AlignedBox) -> Spectrum:
-            x_range = np.linspace(region[0, 0], region[1, 0], n_samples + 1)
-            y_range = np.linspace(region[0, 1], region[1, 1], n_samples + 1)
-            angle_range = np.linspace(np.float32(0), np.float32(np.pi * 2),
-                                      np.square(n_samples) + 1)
-            angle_order = np.arange(np.int32(np.square(n_samples)))
-            np.random.shuffle(angle_order)
+        @njit(fastmath=FASTMATH, error_model='numpy')
+        def generate_rays(x_min: float, y_min: float, x_max: float, y_max: float,
+                          rays: RayPacket, angle_order: npt.NDArray[np.int32],
+                          random_state: RandomState) -> None:
+            # The strata are computed from their sizes on the fly, instead of from arrays of their
+            # boundaries.
+            x_step = (x_max - x_min) / np.float32(n_samples)
+            y_step = (y_max - y_min) / np.float32(n_samples)
+            # The permutation left by the previous pixel is shuffled again in place, which gives a
+            # uniformly random permutation as well.
+            for i in range(len(angle_order) - 1, 0, -1):
+                j = random_index(random_state, i + 1)
+                angle_order[i], angle_order[j] = angle_order[j], angle_order[i]
 
             k = np.uint32(0)
-            ray = np.empty(5, np.float32)
-            li_sum = np.zeros(3, np.float32)
-            valid_count = np.uint32(0)
-
             for row in range(n_samples):
-                y_min = y_range[row]
-                y_max = y_range[row + 1]
+                sample_y_min = y_min + np.float32(row) * y_step
                 for col in range(n_samples):
-                    x_min = x_range[col]
-                    x_max = x_range[col + 1]
-                    i_angle = angle_order[k]
+                    sample_x_min = x_min + np.float32(col) * x_step
+                    angle_min = np.float32(angle_order[k]) * angle_step
+
+                    rays[0, k] = random_uniform(random_state, sample_x_min, sample_x_min + x_step)
+                    rays[1, k] = random_uniform(random_state, sample_y_min, sample_y_min + y_step)
+                    rays[2, k] = random_uniform(random_state, angle_min, angle_min + angle_step)
                     k += np.uint32(1)
-                    angle_min = angle_range[i_angle]
-                    angle_max = angle_range[i_angle + 1]
-
-                    ray[0] = np.random.uniform(x_min, x_max)
-                    ray[1] = np.random.uniform(y_min, y_max)
-                    angle = np.float32(np.random.uniform(angle_min, angle_max))
-                    ray[2] = np.cos(angle)
-                    ray[3] = np.sin(angle)
-                    ray[4] = np.inf
-
-                    li = trace(ray)
-                    if np.all(np.isfinite(li)):
-                        li_sum += li
-                        valid_count += np.uint32(1)
-
-            return li_sum / np.float32(valid_count)
+
+            # The angles are temporarily stored in the row of `d.x`. Converting them to directions
+            # in a separate sweep over contiguous rows lets the loop be vectorized.
+            for k in range(rays.shape[1]):
+                angle = rays[2, k]
+                rays[2, k] = np.cos(angle)
+                rays[3, k] = np.sin(angle)
+            rays[4] = np.inf
+            for k in range(rays.shape[1]):
+                rays[5, k] = np.float32(1) / rays[2, k]
+                rays[6, k] = np.float32(1) / rays[3, k]
+                rays[7, k] = rays[5, k] < 0
+                rays[8, k] = rays[6, k] < 0
+
+        @njit(fastmath=FASTMATH, error_model='numpy')
+        def integrate(x_min: float, y_min: float, x_max: float, y_max: float,
+                      out: F32Array, random_state: RandomState) -> None:
+            height, width, _ = out.shape
+            pixel_width = (x_max - x_min) / np.float32(width)
+            pixel_height = (y_max - y_min) / np.float32(height)
+            rays = np.empty((9, n_samples * n_samples), np.float32)
+            ray = np.empty(9, np.float32)
+            interaction = np.empty(12, np.float32)
+            li = np.empty(3, np.float32)
+            net_attenuation = np.empty(3, np.float32)
+            angle_order = np.arange(np.int32(n_samples * n_samples))
+
+            for row in range(height):
+                pixel_y_min = y_min + np.float32(row) * pixel_height
+                pixel_y_max = pixel_y_min + pixel_height
+                for col in range(width):
+                    pixel_x_min = x_min + np.float32(col) * pixel_width
+                    pixel_x_max = pixel_x_min + pixel_width
+                    generate_rays(pixel_x_min, pixel_y_min, pixel_x_max, pixel_y_max, rays,
+                                  angle_order, random_state)
+                    # The samples are summed in double precision, so that the sums do not lose
+                    # precision when there are a lot of samples.
+                    li_sum_r = np.float64(0)
+                    li_sum_g = np.float64(0)
+                    li_sum_b = np.float64(0)
+                    valid_count = np.uint32(0)
+
+                    for k in range(rays.shape[1]):
+                        ray[:] = rays[:, k]
+                        trace(ray, interaction, li, net_attenuation, random_state)
+                        if np.isfinite(li[0]) and np.isfinite(li[1]) and np.isfinite(li[2]):
+                            li_sum_r += np.float64(li[0])
+                            li_sum_g += np.float64(li[1])
+                            li_sum_b += np.float64(li[2])
+                            valid_count += np.uint32(1)
+
+                    inv_valid_count = np.float64(1) / np.float64(valid_count)
+                    out[row, col, 0] = np.float32(li_sum_r * inv_valid_count)
+                    out[row, col, 1] = np.float32(li_sum_g * inv_valid_count)
+                    out[row, col, 2] = np.float32(li_sum_b * inv_valid_count)
 
         return integrate
@@ -7,7 +7,7 @@ from typing import Callable
 import numpy as np
 from numba import njit
 
-from ..core.base import Material, Ray, SurfaceInteraction
+from ..core.base import FASTMATH, Material, Ray, SurfaceInteraction
 
 
 class ConstantLight(Material):
@@ -25,11 +25,18 @@ class ConstantLight(Material):
         self._li = np.array(li, np.float32)
 
     def _make_scatter_function(self) -> Callable[[Ray, SurfaceInteraction], None]:
-        li = self._li
+        # The channels are captured as scalars, so that they are compiled as constants rather than
+        # loaded from an array on every intersection. The function is inlined into the intersect
+        # function of the entity, which then writes these constants directly on a hit.
+        li_r, li_g, li_b = self._li
 
-        @njit
+        @njit(inline='always', fastmath=FASTMATH, error_model='numpy')
         def scatter(ray: Ray, interaction: SurfaceInteraction) -> None:
-            interaction[4:7] = li
-            interaction[7:10] = -np.inf
+            interaction[4] = li_r
+            interaction[5] = li_g
+            interaction[6] = li_b
+            interaction[7] = -np.inf
+            interaction[8] = -np.inf
+            interaction[9] = -np.inf
 
         return scatter
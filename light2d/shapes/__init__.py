@@ -3,3 +3,4 @@ Child classes of the shape base class.
 """
 
 from .circle import Circle
+from .circle_batch import CircleBatch
@@ -7,7 +7,7 @@ from typing import Callable
 import numpy as np
 from numba import njit
 
-from ..core.base import AlignedBox, Ray, Shape, SurfaceInteraction
+from ..core.base import FASTMATH, AlignedBox, Ray, Shape, SurfaceInteraction
 
 
 class Circle(Shape):
@@ -27,42 +27,49 @@ class Circle(Shape):
         return np.stack((self._center - self._radius, self._center + self._radius))
 
     def _make_intersect_function(self) -> Callable[[Ray, SurfaceInteraction], bool]:
-        center = self._center
-        radius = self._radius
+        # The intersection is computed on scalars rather than 2-element vectors, so that no
+        # temporary arrays are created on every intersection.
+        cx, cy = self._center
+        radius_sq = np.float32(self._radius * self._radius)
 
-        @njit
+        @njit(fastmath=FASTMATH, error_model='numpy')
         def intersect(ray: Ray, interaction: SurfaceInteraction) -> bool:
-            o = ray[0:2]
-            d = ray[2:4]
-            d_norm = np.linalg.norm(d)
-            d_normalized = d / d_norm
+            ox = ray[0]
+            oy = ray[1]
+            dx = ray[2]
+            dy = ray[3]
             t_max = ray[4]
 
-            oc = center - o
-            d_oc = np.dot(d_normalized, oc)
-            delta = np.square(d_oc) - np.dot(oc, oc) + np.square(radius)
+            ocx = cx - ox
+            ocy = cy - oy
+            d_oc = dx * ocx + dy * ocy
+            delta = d_oc * d_oc - (ocx * ocx + ocy * ocy) + radius_sq
             if not delta >= 0:
                 return False
 
             sqrt_delta = np.sqrt(delta)
-            t1 = (d_oc - sqrt_delta) / d_norm
+            t1 = d_oc - sqrt_delta
             if not t1 < t_max:
                 return False
             if 0 < t1:
                 t = t1
             else:
-                t2 = (d_oc + sqrt_delta) / d_norm
+                t2 = d_oc + sqrt_delta
                 if 0 < t2 < t_max:
                     t = t2
                 else:
                     return False
 
-            p = o + d * t
-            n = p - center
-            n /= np.linalg.norm(n)
+            px = ox + dx * t
+            py = oy + dy * t
+            nx = px - cx
+            ny = py - cy
+            inv_n_norm = np.float32(1) / np.sqrt(nx * nx + ny * ny)
             ray[4] = t
-            interaction[0:2] = p
-            interaction[2:4] = n
+            interaction[0] = px
+            interaction[1] = py
+            interaction[2] = nx * inv_n_norm
+            interaction[3] = ny * inv_n_norm
             return True
 
         return intersect